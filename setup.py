@@ -4,8 +4,8 @@ import sys
 from os.path import expanduser, exists
 
 # check Python version, before we do anything
-if sys.version_info[:2] not in [(2, 7), (3, 5), (3, 6), (3, 7)]:
-    sys.stderr.write("The Synapse Client for Python requires Python 2.7, 3.5, 3.6, or 3.7.\n")
+if sys.version_info[:2] not in [(3, 5), (3, 6), (3, 7)]:
+    sys.stderr.write("The Synapse Client for Python requires Python 3.5, 3.6, or 3.7.\n")
     sys.stderr.write("Your Python appears to be version %d.%d.%d\n" % sys.version_info[:3])
     sys.exit(-1)
 
@@ -44,7 +44,7 @@ setup(name='synapseclient',
     ],
     extras_require = {
         'pandas': ["pandas==0.23.0"],
-        'pysftp': ["pysftp>=0.2.8"],
+        'pysftp': ["pysftp>=0.2.9"],
         'boto3' : ["boto3"],
         ':sys_platform=="linux2" or sys_platform=="linux"': ['keyrings.alt==3.1'],
     },
@@ -59,7 +59,6 @@ setup(name='synapseclient',
     classifiers=[
         'Development Status :: 5 - Production/Stable',
         'Programming Language :: Python',
-        'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3.5',
         'Programming Language :: Python :: 3.6',
         'Programming Language :: Python :: 3.7',
@@ -70,5 +69,5 @@ setup(name='synapseclient',
         'Topic :: Scientific/Engineering',
         'Topic :: Scientific/Engineering :: Bio-Informatics'],
     platforms=['any'],
-    python_requires='>=2.7, !=3.0.*, !=3.1.*, !=3.2.*, !=3.3.*, !=3.4.*',
+    python_requires='>=3.5',
 )
@@ -54,9 +54,7 @@ Next, either install the package in the site-packages directory ``python setup.p
 Python 2 Support
 ----------------
 
-The sun is setting on Python 2. Many major open source Python packages are moving to require Python 3.
-
-The Synapse engineering team will step down Python 2.7 support to only bug fixes, and require Python 3 on new feature releases. **Starting with Synapse Python client version 2.0 (will be released in Q1 2019), Synapse Python client will require Python 3.**
+Starting with version 2.0, the Synapse Python client requires Python 3.5 or later. Users still on Python 2.7 should stay on the 1.9.x releases of the client or upgrade to Python 3.
 
 
 Connecting to Synapse
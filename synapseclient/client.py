@@ -1737,7 +1737,8 @@ class Synapse(object):
                     profile = self._get_client_authenticated_s3_profile(fileHandle['endpointUrl'], fileHandle['bucket'])
                     downloaded_path = S3ClientWrapper.download_file(fileHandle['bucket'], fileHandle['endpointUrl'],
                                                                     fileHandle['fileKey'], destination,
-                                                                    profile_name=profile)
+                                                                    profile_name=profile,
+                                                                    file_size=fileHandle.get('contentSize'))
                 else:
                     downloaded_path = self._download_from_URL(fileResult['preSignedURL'], destination, fileHandle['id'],
                                                               expected_md5=fileHandle.get('contentMd5'))
@@ -24,8 +24,7 @@ DEFAULT_POOL_SIZE = 8
 class SingleThreadPool:
 
     def map(self, func, iterable):
-        for item in iterable:
-            func(item)
+        return [func(item) for item in iterable]
 
     def terminate(self):
         pass
@@ -49,11 +48,11 @@ class SingleValue:
     def get_lock(self):
         return FakeLock()
 
-def get_pool():
+def get_pool(size=DEFAULT_POOL_SIZE):
     if config.single_threaded:
         return SingleThreadPool()
     else:
-        return multiprocessing.dummy.Pool(DEFAULT_POOL_SIZE)
+        return multiprocessing.dummy.Pool(size)
 
 
 def get_value(type, value):
@@ -1,23 +1,176 @@
-from __future__ import absolute_import
-from __future__ import division
-from __future__ import print_function
-from __future__ import unicode_literals
-
-try:
-    from urllib.parse import urlparse
-    from urllib.parse import urlunparse
-    from urllib.parse import quote
-    from urllib.parse import unquote
-except ImportError:
-    from urlparse import urlparse
-    from urlparse import urlunparse
-    from urllib import quote
-    from urllib import unquote
-
+import contextlib
+import functools
+import http.client
+import multiprocessing
 import os
+import socket
+import threading
 import time
-from .utils import printTransferProgress, attempt_import
-from multiprocessing import Value
+from urllib.parse import urlparse, urlunparse, quote, unquote
+from . import config
+from . import pool_provider
+from .utils import printTransferProgress, attempt_import, MB
+from .exceptions import SynapseTimeoutError
+
+
+# boto3 and pysftp are optional and slow to import so they are only imported when first needed,
+# the modules are then kept here to skip the import machinery on subsequent calls.
+# their dependencies botocore and s3transfer are kept along with boto3, and paramiko along with pysftp
+_boto3 = None
+_botocore = None
+_s3transfer = None
+_pysftp = None
+_paramiko = None
+
+
+# socket write buffer used by http connections, the stdlib default of 8 KiB results in a write syscall
+# for every 8 KiB of data sent which dominates large S3 uploads
+HTTP_CONNECTION_BLOCKSIZE = 1 * MB
+
+
+def _increase_http_connection_blocksize(connection_class=http.client.HTTPConnection,
+                                        blocksize=HTTP_CONNECTION_BLOCKSIZE):
+    """
+    Raise the default ``blocksize`` of http.client.HTTPConnection (only present in Python 3.7+).
+
+    Note that this is applied when this module is imported and changes the default for every HTTPConnection
+    created in the process, not only the ones used by boto3, e.g. also the requests sessions used for Synapse
+    REST calls and any connections made by code importing synapseclient. It only affects connections that do
+    not pass a blocksize explicitly, urllib3 2.x (and therefore botocore when using it) always passes its own
+    blocksize so S3 transfers only benefit with urllib3 1.x.
+    """
+    init = connection_class.__init__
+    defaults = getattr(init, '__defaults__', None)
+    if not defaults:
+        return
+    args = init.__code__.co_varnames[:init.__code__.co_argcount]
+    positional_with_defaults = args[len(args) - len(defaults):]
+    if 'blocksize' not in positional_with_defaults:
+        return
+    new_defaults = list(defaults)
+    new_defaults[positional_with_defaults.index('blocksize')] = blocksize
+    init.__defaults__ = tuple(new_defaults)
+
+
+# NOTE: global side effect, see _increase_http_connection_blocksize
+_increase_http_connection_blocksize()
+
+
+_s3_client_lock = threading.Lock()
+
+
+@functools.lru_cache(maxsize=None)
+def _create_s3_client(profile_name, endpoint_url):
+    boto3 = S3ClientWrapper._attempt_import_boto3()
+
+    boto_session = boto3.session.Session(profile_name=profile_name)
+    # every transfer thread of every parallel transfer sharing this client needs its own connection,
+    # beyond the pool size connections are discarded and re-established which undoes the concurrency tuning
+    config_kwargs = {'max_pool_connections': S3ClientWrapper.MAX_POOL_CONNECTIONS}
+    # only calculate checksums when the operation requires it or one is explicitly requested,
+    # the default whole-body MD5/CRC32 calculated in python is CPU bound for large uploads.
+    # these options only exist in botocore 1.36+, older versions reject unknown options
+    if 'request_checksum_calculation' in _botocore.config.Config.OPTION_DEFAULTS:
+        config_kwargs['request_checksum_calculation'] = 'when_required'
+        config_kwargs['response_checksum_validation'] = 'when_required'
+    config = _botocore.config.Config(**config_kwargs)
+    return boto_session.client('s3', endpoint_url=endpoint_url, config=config)
+
+
+@functools.lru_cache(maxsize=None)
+def _is_crc32c_available():
+    """
+    botocore computes CRC32C checksums using the hardware accelerated implementation in the AWS CRT
+    and is unable to compute them at all without it.
+    """
+    try:
+        import awscrt.checksums  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def _get_s3_client(profile_name, endpoint_url):
+    """
+    Get a boto3 S3 client for the given profile and endpoint.
+    Creating a session reads the AWS config files and sets up a new connection pool so clients are cached
+    and reused across transfers. Unlike boto3 sessions and resources, clients are thread safe so one client
+    is shared by all threads. Sessions are not, so they are only created while holding the lock.
+    """
+    with _s3_client_lock:
+        return _create_s3_client(profile_name, endpoint_url)
+
+
+# the S3 client of a multiprocess upload worker process
+_upload_worker_client = None
+
+
+def _init_upload_worker(profile_name, endpoint_url):
+    """
+    Give each upload worker process its own boto3 session since sessions and their connection pools
+    must not be shared across a fork.
+    """
+    global _upload_worker_client
+    # drop any clients inherited from the parent process
+    _create_s3_client.cache_clear()
+    _upload_worker_client = _create_s3_client(profile_name, endpoint_url)
+
+
+def _upload_part(bucket, remote_file_key, upload_id, upload_file_path, checksum_algorithm, part):
+    """
+    Upload one part of a multipart upload from within a worker process.
+
+    :param part: a (part_number, offset, length) tuple describing the range of the file to upload
+
+    :returns: the part description expected by CompleteMultipartUpload
+    """
+    part_number, offset, length = part
+    with open(upload_file_path, 'rb') as f:
+        f.seek(offset)
+        body = f.read(length)
+
+    extra_args = {'ChecksumAlgorithm': checksum_algorithm} if checksum_algorithm else {}
+    response = _upload_worker_client.upload_part(Bucket=bucket, Key=remote_file_key, UploadId=upload_id,
+                                                 PartNumber=part_number, Body=body, **extra_args)
+    completed_part = {'PartNumber': part_number, 'ETag': response['ETag']}
+    if checksum_algorithm:
+        checksum_key = 'Checksum' + checksum_algorithm
+        completed_part[checksum_key] = response[checksum_key]
+    return completed_part
+
+
+class _ProvideSizeSubscriber(object):
+    """
+    An s3transfer subscriber that gives the transfer manager the size of the object being downloaded,
+    which saves the HEAD request it would otherwise make to look it up.
+    """
+
+    def __init__(self, size):
+        self._size = size
+
+    def on_queued(self, future, **kwargs):
+        future.meta.provide_transfer_size(self._size)
+
+
+def _run_in_parallel(func, items, max_workers):
+    """
+    Call func on each of items using a pool of threads, or sequentially if synapseclient.config.single_threaded
+    is set.
+
+    :returns: a list in the same order as items containing the value returned by func for each item,
+              or the exception raised by func for that item
+    """
+    def call(item):
+        try:
+            return func(item)
+        except Exception as ex:
+            return ex
+
+    pool = pool_provider.get_pool(max_workers)
+    try:
+        return pool.map(call, items)
+    finally:
+        pool.terminate()
 
 
 class S3ClientWrapper:
@@ -25,129 +178,520 @@ class S3ClientWrapper:
     # These methods are static because in our use case, we always have the bucket and
     # endpoint and usually only call the download/upload once so there is no need to instantiate multiple objects
 
+    DEFAULT_MULTIPART_CHUNKSIZE = 64 * MB
+    DEFAULT_MULTIPART_THRESHOLD = 64 * MB
+    DEFAULT_MAX_CONCURRENCY = 10
+    DEFAULT_IO_CHUNKSIZE = 1 * MB
+    # no checksum is sent by default since many S3 compatible stores reject the x-amz-checksum headers,
+    # pass e.g. 'CRC32C' (which requires boto3[crt]) to have one calculated and validated by S3
+    DEFAULT_CHECKSUM_ALGORITHM = None
+
+    # upper bound of the automatically tuned number of threads used by a single transfer
+    MAX_AUTO_CONCURRENCY = 32
+
+    # S3 starts throttling requests when too many objects are transferred in parallel
+    MAX_BATCH_WORKERS = 16
+
+    # connections kept open by the shared S3 client, enough for a single auto tuned transfer, batch transfers
+    # split them between their workers
+    MAX_POOL_CONNECTIONS = 64
+
+    # files larger than this may be uploaded by multiple processes
+    MULTIPROCESS_UPLOAD_THRESHOLD = 256 * MB
+
+    # minimum number of seconds between progress bar updates
+    PROGRESS_PRINT_INTERVAL = 0.1
+
     @staticmethod
     def _attempt_import_boto3():
         """
-        Check if pysftp is installed and give instructions if not.
+        Check if boto3 is installed and give instructions if not.
+        :return: the boto3 module if available
+        """
+        global _boto3, _botocore, _s3transfer
+        if _boto3 is None:
+            boto3 = attempt_import("boto3",
+                                   "\n\nLibraries required for client authenticated S3 access are not installed!\n"
+                                   "The Synapse client uses boto3 in order to access S3-like storage "
+                                   "locations.\n")
+            # the submodules used here are not imported by the top level packages
+            import boto3.s3.transfer
+            import botocore.config
+            import botocore.exceptions
+            import s3transfer.utils
+            _botocore = botocore
+            _s3transfer = s3transfer
+            _boto3 = boto3
+        return _boto3
+
+    @staticmethod
+    def clear_cache():
         """
-        return attempt_import("boto3",
-                              "\n\nLibraries required for client authenticated S3 access are not installed!\n"
-                              "The Synapse client uses boto3 in order to access S3-like storage "
-                              "locations.\n")
+        Discard the cached boto3 S3 clients, e.g. after AWS credentials or profiles have changed.
+        """
+        with _s3_client_lock:
+            _create_s3_client.cache_clear()
 
     @staticmethod
     def _create_progress_callback_func(file_size, filename, prefix=None):
-        bytes_transferred = Value('d', 0)
-        t0 = time.time()
+        # boto3's transfer manager invokes callbacks from worker threads (not processes)
+        # so a plain counter guarded by a threading lock is sufficient
+        bytes_transferred = [0]
+        last_print = [0.0]
+        bytes_printed = [0]
+        lock = threading.Lock()
+        print_lock = threading.Lock()
+        t0 = time.monotonic()
 
         def progress_callback(bytes):
-            with bytes_transferred.get_lock():
-                bytes_transferred.value += bytes
-                printTransferProgress(bytes_transferred.value, file_size, prefix=prefix, postfix=filename,
-                                      dt=time.time() - t0, previouslyTransferred=0)
+            now = time.monotonic()
+            # keep the critical section small since every transfer thread fires callbacks,
+            # the progress bar is printed outside of the lock from a snapshot of the counter
+            with lock:
+                bytes_transferred[0] += bytes
+                snapshot = bytes_transferred[0]
+                # callbacks fire on every socket read, limit the progress bar refresh rate
+                # but always print the final update
+                should_print = now - last_print[0] >= S3ClientWrapper.PROGRESS_PRINT_INTERVAL \
+                    or snapshot == file_size
+                if should_print:
+                    last_print[0] = now
+            if should_print:
+                # only the throttled updates contend for this lock. An older snapshot that lost the race
+                # is skipped so it can not overwrite a newer one, or print after the transfer is done
+                with print_lock:
+                    if snapshot > bytes_printed[0]:
+                        bytes_printed[0] = snapshot
+                        printTransferProgress(snapshot, file_size, prefix=prefix, postfix=filename,
+                                              dt=now - t0, previouslyTransferred=0)
         return progress_callback
 
     @staticmethod
-    def download_file(bucket, endpoint_url, remote_file_key, download_file_path, profile_name=None, show_progress=True):
+    def _create_transfer_config(multipart_chunksize, multipart_threshold, max_concurrency, io_chunksize):
+        """
+        Build the boto3 TransferConfig used for uploads and downloads.
+        The boto3 defaults (8 MiB parts, 256 KiB io chunks) underutilize fast network links.
 
+        On downloads, s3transfer already hands the received chunks to a dedicated IO thread which writes them
+        to disk while the network threads keep receiving, so io_chunksize is what determines the number of
+        write syscalls. A single streamed GET with io_uring writes was considered but gives up the parallel
+        ranged GETs, which matter more than the local write cost, and requires a native dependency.
+        """
         boto3 = S3ClientWrapper._attempt_import_boto3()
-        # if we boto3 is importable, botocore should also be importable since it is a dependency of boto3
-        import botocore
+        return boto3.s3.transfer.TransferConfig(multipart_threshold=multipart_threshold,
+                                                multipart_chunksize=multipart_chunksize,
+                                                max_concurrency=max_concurrency,
+                                                io_chunksize=io_chunksize)
+
+    @staticmethod
+    def _auto_transfer_config(file_size, multipart_chunksize=None, multipart_threshold=DEFAULT_MULTIPART_THRESHOLD,
+                              max_concurrency=None, io_chunksize=DEFAULT_IO_CHUNKSIZE):
+        """
+        Build a TransferConfig with the part size and number of threads scaled to the size of the file.
+        Throughput only saturates fast links once max_concurrency * multipart_chunksize covers the
+        bandwidth-delay product, so larger files get both larger parts and more threads.
+        Explicitly given values are used as is, as are the defaults if the file size is unknown.
+        """
+        if multipart_chunksize is None:
+            multipart_chunksize = S3ClientWrapper.DEFAULT_MULTIPART_CHUNKSIZE if file_size is None \
+                else max(8 * MB, min(64 * MB, file_size // 32))
+        if max_concurrency is None:
+            max_concurrency = S3ClientWrapper.DEFAULT_MAX_CONCURRENCY if file_size is None \
+                else min(S3ClientWrapper.MAX_AUTO_CONCURRENCY, max(4, file_size // (16 * MB)))
+        return S3ClientWrapper._create_transfer_config(multipart_chunksize, multipart_threshold,
+                                                       max_concurrency, io_chunksize)
 
-        boto_session = boto3.session.Session(profile_name=profile_name)
-        s3 = boto_session.resource('s3', endpoint_url=endpoint_url)
+    @staticmethod
+    def download_file(bucket, endpoint_url, remote_file_key, download_file_path, profile_name=None, show_progress=True,
+                      file_size=None, multipart_chunksize=None, multipart_threshold=DEFAULT_MULTIPART_THRESHOLD,
+                      max_concurrency=None, io_chunksize=DEFAULT_IO_CHUNKSIZE):
 
-        try:
-            s3_obj = s3.Object(bucket, remote_file_key)
+        boto3 = S3ClientWrapper._attempt_import_boto3()
+        client = _get_s3_client(profile_name, endpoint_url)
 
+        try:
             progress_callback = None
             if show_progress:
-                s3_obj.load()
-                file_size = s3_obj.content_length
+                # when the caller already knows the size we can avoid a HEAD request to look it up
+                if file_size is None:
+                    file_size = client.head_object(Bucket=bucket, Key=remote_file_key)['ContentLength']
                 filename = os.path.basename(download_file_path)
                 progress_callback = S3ClientWrapper._create_progress_callback_func(file_size, filename,
                                                                                    prefix='Downloading')
-            s3_obj.download_file(download_file_path, Callback=progress_callback)
+            # file_size is only known here if it was passed in or looked up for the progress bar,
+            # otherwise the default transfer settings are used rather than making a HEAD request just for tuning
+            transfer_config = S3ClientWrapper._auto_transfer_config(file_size, multipart_chunksize, multipart_threshold,
+                                                                    max_concurrency, io_chunksize)
+
+            # use the transfer manager directly rather than client.download_file so that a known size can be
+            # handed to it, otherwise it makes its own HEAD request to find the size
+            subscribers = []
+            if progress_callback:
+                subscribers.append(boto3.s3.transfer.ProgressCallbackInvoker(progress_callback))
+            if file_size is not None:
+                subscribers.append(_ProvideSizeSubscriber(file_size))
+            with boto3.s3.transfer.create_transfer_manager(client, transfer_config) as manager:
+                future = manager.download(bucket, remote_file_key, download_file_path, subscribers=subscribers)
+                future.result()
             return download_file_path
-        except botocore.exceptions.ClientError as e:
-            if e.response['Error']['Code'] == "404":
+        except _botocore.exceptions.ClientError as e:
+            # a HEAD request for a missing key fails with 404, a GET with NoSuchKey
+            if e.response['Error']['Code'] in ("404", "NoSuchKey"):
                 raise ValueError("The key:%s does not exist in bucket:%s.", remote_file_key, bucket)
             else:
                 raise
 
     @staticmethod
-    def upload_file(bucket, endpoint_url, remote_file_key, upload_file_path, profile_name=None, show_progress=True):
-        boto3 = S3ClientWrapper._attempt_import_boto3()
-
+    def upload_file(bucket, endpoint_url, remote_file_key, upload_file_path, profile_name=None, show_progress=True,
+                    multipart_chunksize=None, multipart_threshold=DEFAULT_MULTIPART_THRESHOLD,
+                    max_concurrency=None, io_chunksize=DEFAULT_IO_CHUNKSIZE,
+                    checksum_algorithm=DEFAULT_CHECKSUM_ALGORITHM, use_processes=False):
         if not os.path.isfile(upload_file_path):
             raise ValueError("The path: [%s] does not exist or is not a file", upload_file_path)
 
-        boto_session = boto3.session.Session(profile_name=profile_name)
-        s3 = boto_session.resource('s3', endpoint_url=endpoint_url)
+        client = _get_s3_client(profile_name, endpoint_url)
+
+        file_size = os.stat(upload_file_path).st_size
 
         progress_callback = None
         if show_progress:
-            file_size = os.stat(upload_file_path).st_size
             filename = os.path.basename(upload_file_path)
             progress_callback = S3ClientWrapper._create_progress_callback_func(file_size, filename, prefix='Uploading')
 
+        transfer_config = S3ClientWrapper._auto_transfer_config(file_size, multipart_chunksize, multipart_threshold,
+                                                                max_concurrency, io_chunksize)
+        extra_args = {}
+        if checksum_algorithm:
+            # an explicitly requested checksum is never dropped since nothing else validates the transfer
+            if checksum_algorithm == 'CRC32C' and not _is_crc32c_available():
+                raise ValueError("CRC32C checksums require the AWS CRT, install it with: pip install boto3[crt]")
+            extra_args['ChecksumAlgorithm'] = checksum_algorithm
+
+        if use_processes and not config.single_threaded \
+                and file_size > S3ClientWrapper.MULTIPROCESS_UPLOAD_THRESHOLD:
+            S3ClientWrapper._multiprocess_upload(client, bucket, endpoint_url, remote_file_key,
+                                                 upload_file_path, file_size, profile_name, transfer_config,
+                                                 extra_args.get('ChecksumAlgorithm'), progress_callback)
+            return upload_file_path
+
         # automatically determines whether to perform multi-part upload
-        s3.Bucket(bucket).upload_file(upload_file_path, remote_file_key, Callback=progress_callback)
+        client.upload_file(upload_file_path, bucket, remote_file_key, Callback=progress_callback,
+                           Config=transfer_config, ExtraArgs=extra_args)
         return upload_file_path
 
+    @staticmethod
+    def _multiprocess_upload(client, bucket, endpoint_url, remote_file_key, upload_file_path, file_size,
+                             profile_name, transfer_config, checksum_algorithm, progress_callback):
+        """
+        Perform a multipart upload with the parts uploaded by a pool of processes instead of threads, so that
+        the checksum calculation and TLS encryption of the parts are not serialized by the GIL.
+        Each worker reads its own byte range of the file so the data is never copied between processes.
+        The multipart upload is created and completed (or aborted on failure) in this process.
+
+        The workers are started with the spawn start method since forking a process that is running other threads
+        (boto3 transfer threads, paramiko transports, batch transfer pools) is unsafe. As with any use of spawn,
+        scripts calling this must guard their entry point with ``if __name__ == '__main__':``.
+        """
+        # keep the part size within the S3 limits (5 MiB minimum, 10,000 parts maximum) before creating the upload
+        part_size = _s3transfer.utils.ChunksizeAdjuster().adjust_chunksize(transfer_config.multipart_chunksize,
+                                                                           file_size)
+        parts = [(part_number, offset, min(part_size, file_size - offset))
+                 for part_number, offset in enumerate(range(0, file_size, part_size), start=1)]
+        processes = min(transfer_config.max_concurrency, multiprocessing.cpu_count(), len(parts))
+
+        extra_args = {'ChecksumAlgorithm': checksum_algorithm} if checksum_algorithm else {}
+        upload_id = client.create_multipart_upload(Bucket=bucket, Key=remote_file_key, **extra_args)['UploadId']
+        try:
+            upload_part = functools.partial(_upload_part, bucket, remote_file_key, upload_id, upload_file_path,
+                                            checksum_algorithm)
+            completed_parts = []
+            pool = multiprocessing.get_context('spawn').Pool(processes, initializer=_init_upload_worker,
+                                                             initargs=(profile_name, endpoint_url))
+            try:
+                for completed_part in pool.imap_unordered(upload_part, parts):
+                    completed_parts.append(completed_part)
+                    if progress_callback:
+                        progress_callback(parts[completed_part['PartNumber'] - 1][2])
+            finally:
+                pool.terminate()
+
+            completed_parts.sort(key=lambda completed_part: completed_part['PartNumber'])
+            client.complete_multipart_upload(Bucket=bucket, Key=remote_file_key, UploadId=upload_id,
+                                             MultipartUpload={'Parts': completed_parts})
+        except BaseException:
+            client.abort_multipart_upload(Bucket=bucket, Key=remote_file_key, UploadId=upload_id)
+            raise
+
+    @staticmethod
+    def download_files(bucket, endpoint_url, items, profile_name=None, max_workers=MAX_BATCH_WORKERS,
+                       show_progress=False):
+        """
+        Download multiple objects from the same bucket in parallel, sharing one boto3 client.
+
+        :param bucket:          the bucket containing the objects
+        :param endpoint_url:    the S3 endpoint
+        :param items:           an iterable of (remote_file_key, download_file_path) or
+                                (remote_file_key, download_file_path, file_size) tuples
+        :param profile_name:    the AWS profile used for authentication
+        :param max_workers:     the number of objects to download at the same time, capped at MAX_BATCH_WORKERS
+        :param show_progress:   whether to print a progress bar for each object
+
+        :returns: a list in the same order as items containing the path of each downloaded file,
+                  or the exception raised if that download failed
+        """
+        max_workers = min(max_workers, S3ClientWrapper.MAX_BATCH_WORKERS)
+        max_concurrency = S3ClientWrapper._batch_max_concurrency(max_workers)
+        return _run_in_parallel(
+            lambda item: S3ClientWrapper.download_file(bucket, endpoint_url, item[0], item[1],
+                                                       profile_name=profile_name, show_progress=show_progress,
+                                                       file_size=item[2] if len(item) > 2 else None,
+                                                       max_concurrency=max_concurrency),
+            items, max_workers)
+
+    @staticmethod
+    def upload_files(bucket, endpoint_url, items, profile_name=None, max_workers=MAX_BATCH_WORKERS,
+                     show_progress=False):
+        """
+        Upload multiple files to the same bucket in parallel, sharing one boto3 client.
+
+        :param bucket:          the bucket the objects are uploaded to
+        :param endpoint_url:    the S3 endpoint
+        :param items:           an iterable of (remote_file_key, upload_file_path) tuples
+        :param profile_name:    the AWS profile used for authentication
+        :param max_workers:     the number of files to upload at the same time, capped at MAX_BATCH_WORKERS
+        :param show_progress:   whether to print a progress bar for each file
+
+        :returns: a list in the same order as items containing the path of each uploaded file,
+                  or the exception raised if that upload failed
+        """
+        max_workers = min(max_workers, S3ClientWrapper.MAX_BATCH_WORKERS)
+        max_concurrency = S3ClientWrapper._batch_max_concurrency(max_workers)
+        return _run_in_parallel(
+            lambda item: S3ClientWrapper.upload_file(bucket, endpoint_url, item[0], item[1],
+                                                     profile_name=profile_name, show_progress=show_progress,
+                                                     max_concurrency=max_concurrency),
+            items, max_workers)
+
+    @staticmethod
+    def _batch_max_concurrency(max_workers):
+        """
+        The number of threads each transfer of a batch may use so that all of them together stay within the
+        connection pool of the shared S3 client.
+        """
+        return max(1, S3ClientWrapper.MAX_POOL_CONNECTIONS // max_workers)
+
+
+class _SFTPConnectionPool(object):
+    """
+    A capped pool of open SFTP connections to a single host for a single set of credentials.
+    Idle connections are kept and handed out again instead of repeating the SSH handshake.
+    """
+
+    def __init__(self, connect, max_connections, is_alive=None, max_idle_time=None):
+        """
+        :param connect:         a callable with no arguments that opens a new connection
+        :param max_connections: maximum number of connections this pool will open at the same time
+        :param is_alive:        a callable taking a connection that returns False if the connection has been dropped,
+                                idle connections are checked with it before being handed out
+        :param max_idle_time:   seconds after which an idle connection is closed instead of handed out again
+        """
+        self._connect = connect
+        self._is_alive = is_alive
+        self._max_idle_time = max_idle_time
+        self._max_connections = max_connections
+        # (connection, time it was returned) pairs
+        self._idle = []
+        # checked out connections that were handed out from the idle connections rather than newly opened
+        self._reused = set()
+        # number of open connections, both idle and checked out
+        self._size = 0
+        # notified whenever a connection is returned or a slot is freed
+        self._condition = threading.Condition()
+
+    def get(self, timeout=None, reuse=True):
+        """
+        Check out a connection, opening a new one if none are idle and the pool is not at capacity.
+
+        :param timeout: seconds to wait for a connection to be returned to the pool when it is at capacity
+        :param reuse:   whether an idle connection may be handed out, if False a new connection is always opened,
+                        closing an idle connection to make room for it if the pool is at capacity
+
+        :returns: an open connection
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            replaced = None
+            with self._condition:
+                while not self._idle and self._size >= self._max_connections:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        raise SynapseTimeoutError("Timed out after %s seconds waiting for an available SFTP "
+                                                  "connection" % timeout)
+                    self._condition.wait(remaining)
+                if self._idle and reuse:
+                    connection, returned_at = self._idle.pop()
+                    self._reused.add(connection)
+                else:
+                    connection = None
+                    if self._size < self._max_connections:
+                        self._size += 1
+                    else:
+                        # the new connection takes the place of the longest idle one
+                        replaced, _ = self._idle.pop(0)
+
+            if connection is None:
+                if replaced is not None:
+                    self._close_quietly(replaced)
+                try:
+                    return self._connect()
+                except Exception:
+                    self._release()
+                    raise
+
+            # a firewall or NAT may have silently dropped a connection that was idle for long,
+            # which is_alive can not detect, and the server may have closed the session while it was idle
+            expired = self._max_idle_time is not None and time.monotonic() - returned_at > self._max_idle_time
+            if not expired and (self._is_alive is None or self._is_alive(connection)):
+                return connection
+            self.discard(connection)
+
+    def is_reused(self, connection):
+        """
+        :returns: True if the checked out connection was handed out from the idle connections, in which case it may
+                  have been dropped while idle without the pool noticing
+        """
+        with self._condition:
+            return connection in self._reused
+
+    def put(self, connection):
+        """
+        Return a checked out connection to the pool so that it may be reused.
+        """
+        with self._condition:
+            self._reused.discard(connection)
+            self._idle.append((connection, time.monotonic()))
+            self._condition.notify()
+
+    def discard(self, connection):
+        """
+        Close a checked out connection that can not be reused, freeing up its place in the pool.
+        A new connection will be opened the next time one is needed.
+        """
+        with self._condition:
+            self._reused.discard(connection)
+        self._release()
+        self._close_quietly(connection)
+
+    def close(self):
+        """
+        Close all idle connections.
+        """
+        with self._condition:
+            idle = self._idle
+            self._idle = []
+            self._size -= len(idle)
+            self._condition.notify_all()
+        for connection, _ in idle:
+            connection.close()
+
+    def _release(self):
+        with self._condition:
+            self._size -= 1
+            self._condition.notify()
+
+    @staticmethod
+    def _close_quietly(connection):
+        try:
+            connection.close()
+        except Exception:
+            # the connection is most likely already broken
+            pass
+
 
 class SFTPWrapper:
 
+    # Each new pysftp connection requires a full SSH handshake so connections are pooled per host and credentials.
+    # The number of connections to a single host is capped since too many parallel handshakes are likely
+    # to be throttled or refused by the server.
+    MAX_CONNECTIONS_PER_HOST = 8
+    CONNECTION_POOL_TIMEOUT = 600
+
+    # size of the blocks read from remote files and written to local files during downloads
+    BUFFER_SIZE = 1 * MB
+
+    # SSH channel flow control settings, paramiko defaults to a 2 MiB window and 32 KiB packets
+    WINDOW_SIZE = 4 * MB
+    MAX_PACKET_SIZE = 64 * 2**10
+
+    # Pooled connections may sit idle between transfers. Keepalive messages stop firewalls and NATs from dropping
+    # them, connections idle for longer than MAX_IDLE_TIME are replaced anyway, and the channel timeout makes a
+    # transfer on a connection that was dropped regardless fail instead of hanging.
+    KEEPALIVE_INTERVAL = 30
+    MAX_IDLE_TIME = 300
+    CHANNEL_TIMEOUT = 300
+
+    _connection_pool = {}
+    _connection_pool_lock = threading.Lock()
+
     @staticmethod
     def _attempt_import_sftp():
         """
         Check if pysftp is installed and give instructions if not.
         :return: the pysftp module if available
         """
-        return attempt_import("pysftp",
-                              "\n\nLibraries required for SFTP are not installed!\n"
-                              "The Synapse client uses pysftp in order to access SFTP storage locations. "
-                              "This library in turn depends on pycrypto.\n"
-                              "For Windows systems without a C/C++ compiler, install the appropriate binary "
-                              "distribution of pycrypto from:\n"
-                              "http://www.voidspace.org.uk/python/modules.shtml#pycrypto\n\n"
-                              "For more information, see: http://docs.synapse.org/python/sftp.html")
+        global _pysftp, _paramiko
+        if _pysftp is None:
+            pysftp = attempt_import("pysftp",
+                                    "\n\nLibraries required for SFTP are not installed!\n"
+                                    "The Synapse client uses pysftp in order to access SFTP storage locations. "
+                                    "This library in turn depends on pycrypto.\n"
+                                    "For Windows systems without a C/C++ compiler, install the appropriate binary "
+                                    "distribution of pycrypto from:\n"
+                                    "http://www.voidspace.org.uk/python/modules.shtml#pycrypto\n\n"
+                                    "For more information, see: http://docs.synapse.org/python/sftp.html")
+            import paramiko
+            _paramiko = paramiko
+            _pysftp = pysftp
+        return _pysftp
 
     @staticmethod
+    @functools.lru_cache(maxsize=1024)
     def _parse_for_sftp(url):
+        # cached since batch transfers typically parse the same few server URLs over and over
         parsedURL = urlparse(url)
         if parsedURL.scheme != 'sftp':
             raise(NotImplementedError("This method only supports sftp URLs of the form sftp://..."))
         return parsedURL
 
     @staticmethod
-    def upload_file(filepath, url, username=None, password=None):
+    def upload_file(filepath, url, username=None, password=None, show_progress=True):
         """
         Performs upload of a local file to an sftp server.
 
-        :param filepath:    The file to be uploaded
-        :param url:         URL where file will be deposited. Should include path and protocol. e.g.
-                            sftp://sftp.example.com/path/to/file/store
-        :param username:    username on sftp server
-        :param password:    password for authentication on the sftp server
+        :param filepath:        The file to be uploaded
+        :param url:             URL where file will be deposited. Should include path and protocol. e.g.
+                                sftp://sftp.example.com/path/to/file/store
+        :param username:        username on sftp server
+        :param password:        password for authentication on the sftp server
+        :param show_progress:   whether to print a progress bar
 
         :returns: A URL where file is stored
         """
-        pysftp = SFTPWrapper._attempt_import_sftp()
-
         parsedURL = SFTPWrapper._parse_for_sftp(url)
+        remote_path = parsedURL.path + '/' + os.path.basename(filepath)
 
-        with pysftp.Connection(parsedURL.hostname, username=username, password=password) as sftp:
+        def upload(sftp):
             sftp.makedirs(parsedURL.path)
-            with sftp.cd(parsedURL.path):
-                sftp.put(filepath, preserve_mtime=True, callback=printTransferProgress)
+            SFTPWrapper._put(sftp.sftp_client, filepath, remote_path, show_progress)
+
+        SFTPWrapper._call_with_connection(parsedURL.hostname, username, password, upload)
 
-        path = quote(parsedURL.path+'/'+os.path.split(filepath)[-1])
+        path = quote(remote_path)
         parsedURL = parsedURL._replace(path=path)
         return urlunparse(parsedURL)
 
     @staticmethod
-    def download_file(url, localFilepath=None, username=None, password=None):
+    def download_file(url, localFilepath=None, username=None, password=None, show_progress=True):
         """
         Performs download of a file from an sftp server.
 
@@ -155,12 +699,11 @@ class SFTPWrapper:
         :param localFilepath:   location where to store file
         :param username:        username on server
         :param password:        password for authentication on  server
+        :param show_progress:   whether to print a progress bar
 
         :returns: localFilePath
 
         """
-        pysftp = SFTPWrapper._attempt_import_sftp()
-
         parsedURL = SFTPWrapper._parse_for_sftp(url)
 
         # Create the local file path if it doesn't exist
@@ -169,12 +712,183 @@ class SFTPWrapper:
             localFilepath = os.getcwd()
         if os.path.isdir(localFilepath):
             localFilepath = os.path.join(localFilepath, path.split('/')[-1])
-        # Check and create the directory
+        # Create the directory
         dir = os.path.dirname(localFilepath)
-        if not os.path.exists(dir):
-            os.makedirs(dir)
+        if dir:
+            os.makedirs(dir, exist_ok=True)
 
         # Download file
-        with pysftp.Connection(parsedURL.hostname, username=username, password=password) as sftp:
-            sftp.get(path, localFilepath, preserve_mtime=True, callback=printTransferProgress)
+        SFTPWrapper._call_with_connection(
+            parsedURL.hostname, username, password,
+            lambda sftp: SFTPWrapper._get(sftp.sftp_client, path, localFilepath, show_progress))
         return localFilepath
+
+    @staticmethod
+    def _put(sftp_client, filepath, remote_path, show_progress=True):
+        """
+        Upload using the underlying paramiko SFTPClient, which pipelines the writes, instead of pysftp's put.
+        """
+        local_stat = os.stat(filepath)
+        with open(filepath, 'rb') as local_file:
+            # confirm=False skips the stat of the remote file after the upload, saving a round trip
+            sftp_client.putfo(local_file, remote_path, file_size=local_stat.st_size,
+                              callback=printTransferProgress if show_progress else None, confirm=False)
+        sftp_client.utime(remote_path, (local_stat.st_atime, local_stat.st_mtime))
+
+    @staticmethod
+    def _get(sftp_client, remote_path, localFilepath, show_progress=True):
+        """
+        Download using the underlying paramiko SFTPClient, prefetching the remote file so that read requests are
+        pipelined and streaming it to disk in large blocks.
+        """
+        # the size is needed up front so that prefetch can issue read requests for the whole file at once
+        remote_stat = sftp_client.stat(remote_path)
+        file_size = remote_stat.st_size
+        with sftp_client.open(remote_path, 'rb') as remote_file:
+            remote_file.prefetch(file_size)
+            transferred = 0
+            with open(localFilepath, 'wb') as local_file:
+                while True:
+                    data = remote_file.read(SFTPWrapper.BUFFER_SIZE)
+                    if not data:
+                        break
+                    local_file.write(data)
+                    transferred += len(data)
+                    if show_progress:
+                        printTransferProgress(transferred, file_size)
+        os.utime(localFilepath, (remote_stat.st_atime, remote_stat.st_mtime))
+
+    @staticmethod
+    def upload_files(pairs, username=None, password=None, show_progress=False):
+        """
+        Performs upload of multiple local files to sftp servers in parallel, reusing pooled connections.
+
+        :param pairs:           an iterable of (filepath, url) tuples, see :py:func:`upload_file`
+        :param username:        username on sftp server
+        :param password:        password for authentication on the sftp server
+        :param show_progress:   whether to print a progress bar for each file
+
+        :returns: a list in the same order as pairs containing the URL where each file is stored,
+                  or the exception raised if that upload failed
+        """
+        # no more workers than pooled connections, any extra would just wait for a connection
+        return _run_in_parallel(
+            lambda pair: SFTPWrapper.upload_file(pair[0], pair[1], username=username, password=password,
+                                                 show_progress=show_progress),
+            pairs,
+            SFTPWrapper.MAX_CONNECTIONS_PER_HOST)
+
+    @staticmethod
+    def download_files(pairs, username=None, password=None, show_progress=False):
+        """
+        Performs download of multiple files from sftp servers in parallel, reusing pooled connections.
+
+        :param pairs:           an iterable of (url, localFilepath) tuples, see :py:func:`download_file`
+        :param username:        username on server
+        :param password:        password for authentication on server
+        :param show_progress:   whether to print a progress bar for each file
+
+        :returns: a list in the same order as pairs containing the path of each downloaded file,
+                  or the exception raised if that download failed
+        """
+        return _run_in_parallel(
+            lambda pair: SFTPWrapper.download_file(pair[0], pair[1], username=username, password=password,
+                                                   show_progress=show_progress),
+            pairs,
+            SFTPWrapper.MAX_CONNECTIONS_PER_HOST)
+
+    @staticmethod
+    def _call_with_connection(hostname, username, password, operation):
+        """
+        Call operation with a pooled connection and return its result. A connection dropped by a firewall or NAT
+        while it was idle in the pool can not be detected up front, so if operation fails on a reused connection
+        because the connection is broken, it is retried once on a newly opened connection.
+        """
+        pool = SFTPWrapper._get_connection_pool(hostname, username, password)
+        reused = False
+        try:
+            with SFTPWrapper._borrow_connection(hostname, username, password) as connection:
+                reused = pool.is_reused(connection)
+                return operation(connection)
+        except SFTPWrapper._broken_connection_errors():
+            if not reused:
+                raise
+        with SFTPWrapper._borrow_connection(hostname, username, password, reuse=False) as connection:
+            return operation(connection)
+
+    @staticmethod
+    def _broken_connection_errors():
+        # paramiko is imported along with pysftp, before any connection is opened
+        return _paramiko.SSHException, EOFError, ConnectionError, socket.timeout
+
+    @staticmethod
+    @contextlib.contextmanager
+    def _borrow_connection(hostname, username, password, reuse=True):
+        """
+        Check out a pooled connection for the duration of a with block. The connection is always given back
+        to the pool, unless the block failed with an error indicating the connection itself is broken or was
+        interrupted, in which case it is closed and discarded instead.
+
+        :param reuse: whether an idle connection may be used, if False a new connection is opened
+        """
+        pool = SFTPWrapper._get_connection_pool(hostname, username, password)
+        connection = pool.get(timeout=SFTPWrapper.CONNECTION_POOL_TIMEOUT, reuse=reuse)
+        # anything interrupting the transfer that is not an Exception (e.g. KeyboardInterrupt) may leave the
+        # connection in the middle of a request so it is only considered reusable if the block completes
+        # or fails with an ordinary error
+        broken = True
+        try:
+            yield connection
+            broken = False
+        except SFTPWrapper._broken_connection_errors():
+            raise
+        except Exception:
+            # any other error (e.g. a missing remote file) leaves the connection usable
+            # unless the SSH transport went down with it
+            broken = not connection._transport.is_active()
+            raise
+        finally:
+            if broken:
+                pool.discard(connection)
+            else:
+                pool.put(connection)
+
+    @staticmethod
+    def _get_connection_pool(hostname, username, password):
+        pysftp = SFTPWrapper._attempt_import_sftp()
+        # the password is part of the key so that connections are never shared with callers using
+        # different credentials than the ones the connections were authenticated with
+        key = (hostname, username, password)
+        with SFTPWrapper._connection_pool_lock:
+            pool = SFTPWrapper._connection_pool.get(key)
+            if pool is None:
+                pool = _SFTPConnectionPool(lambda: SFTPWrapper._connect(pysftp, hostname, username, password),
+                                           SFTPWrapper.MAX_CONNECTIONS_PER_HOST,
+                                           is_alive=lambda connection: connection._transport.is_active(),
+                                           max_idle_time=SFTPWrapper.MAX_IDLE_TIME)
+                SFTPWrapper._connection_pool[key] = pool
+            return pool
+
+    @staticmethod
+    def _connect(pysftp, hostname, username, password):
+        connection = pysftp.Connection(hostname, username=username, password=password)
+        # pysftp opens the SFTP channel lazily, so the transport defaults still apply to it. The larger window
+        # keeps more prefetched read requests in flight on high latency links before the server has to wait.
+        transport = connection._transport
+        transport.default_window_size = SFTPWrapper.WINDOW_SIZE
+        transport.default_max_packet_size = SFTPWrapper.MAX_PACKET_SIZE
+        transport.set_keepalive(SFTPWrapper.KEEPALIVE_INTERVAL)
+        # setting the timeout opens the SFTP channel, so this must come after the transport defaults
+        connection.timeout = SFTPWrapper.CHANNEL_TIMEOUT
+        return connection
+
+    @staticmethod
+    def close_connections():
+        """
+        Close all idle pooled SFTP connections.
+        """
+        with SFTPWrapper._connection_pool_lock:
+            pools = list(SFTPWrapper._connection_pool.values())
+            SFTPWrapper._connection_pool.clear()
+        for pool in pools:
+            pool.close()
@@ -14,8 +14,9 @@ class TestSingleThreadPool:
     def test_map(self):
         test_func = MagicMock()
         pool = SingleThreadPool()
-        pool.map(test_func, range(0, 10))
+        results = pool.map(test_func, range(0, 10))
         test_func.assert_has_calls(call(x) for x in range(0, 10))
+        assert_equal([test_func.return_value] * 10, results)
 
 
 class TestPoolProvider:
@@ -30,6 +31,14 @@ class TestPoolProvider:
         synapseclient.config.single_threaded = False
         assert_is_instance(get_pool(), ThreadPool)
 
+    def test_get_pool_size(self):
+        synapseclient.config.single_threaded = False
+        pool = get_pool(3)
+        try:
+            assert_equal(3, pool._processes)
+        finally:
+            pool.terminate()
+
 
 class TestGetValue:
     def setup(self):
@@ -0,0 +1,803 @@
+import contextlib
+import functools
+import os
+import socket
+import tempfile
+import threading
+import time
+from multiprocessing.dummy import Pool
+
+from mock import patch, call, MagicMock, PropertyMock
+from nose.tools import assert_equals, assert_false, assert_is, assert_is_not, assert_is_instance, assert_not_in, \
+    assert_raises, assert_true
+
+import synapseclient
+from synapseclient.exceptions import SynapseTimeoutError
+from synapseclient.utils import MB, GB
+from synapseclient import remote_file_storage_wrappers
+from synapseclient.remote_file_storage_wrappers import S3ClientWrapper, SFTPWrapper, _SFTPConnectionPool
+
+
+def test_increase_http_connection_blocksize():
+    class Connection(object):
+        def __init__(self, host, port=None, timeout=None, blocksize=8192):
+            self.blocksize = blocksize
+
+    remote_file_storage_wrappers._increase_http_connection_blocksize(Connection, 1 * MB)
+
+    assert_equals(1 * MB, Connection('host').blocksize)
+    # explicitly passed values are unaffected
+    assert_equals(16, Connection('host', blocksize=16).blocksize)
+
+
+def test_increase_http_connection_blocksize__no_blocksize_parameter():
+    class Connection(object):
+        def __init__(self, host, port=None, timeout=None):
+            pass
+
+    remote_file_storage_wrappers._increase_http_connection_blocksize(Connection, 1 * MB)
+
+    assert_equals((None, None), Connection.__init__.__defaults__)
+
+
+def test_create_transfer_config():
+    boto3 = MagicMock()
+    transfer_module = boto3.s3.transfer
+    with patch.object(S3ClientWrapper, '_attempt_import_boto3', return_value=boto3):
+        transfer_config = S3ClientWrapper._create_transfer_config(16 * MB, 32 * MB, 8, 1 * MB)
+
+    assert_is(transfer_module.TransferConfig.return_value, transfer_config)
+    transfer_module.TransferConfig.assert_called_once_with(multipart_chunksize=16 * MB, multipart_threshold=32 * MB,
+                                                           max_concurrency=8, io_chunksize=1 * MB)
+
+
+def test_upload_file__transfer_config():
+    fd, path = tempfile.mkstemp()
+    with os.fdopen(fd, 'wb') as f:
+        f.write(b'0123456789')
+
+    client = MagicMock()
+    try:
+        with patch.object(remote_file_storage_wrappers, '_get_s3_client', return_value=client), \
+                patch.object(S3ClientWrapper, '_auto_transfer_config') as mock_auto_transfer_config:
+            S3ClientWrapper.upload_file('bucket', 'https://s3.amazonaws.com', 'key', path, show_progress=False,
+                                        multipart_chunksize=16 * MB, max_concurrency=8, checksum_algorithm=None)
+    finally:
+        os.remove(path)
+
+    mock_auto_transfer_config.assert_called_once_with(10, 16 * MB, S3ClientWrapper.DEFAULT_MULTIPART_THRESHOLD, 8,
+                                                      S3ClientWrapper.DEFAULT_IO_CHUNKSIZE)
+    client.upload_file.assert_called_once_with(path, 'bucket', 'key', Callback=None,
+                                               Config=mock_auto_transfer_config.return_value, ExtraArgs={})
+
+
+class FakeBotocoreConfig(object):
+    OPTION_DEFAULTS = {'max_pool_connections': 10}
+
+    def __init__(self, **kwargs):
+        unknown = set(kwargs) - set(self.OPTION_DEFAULTS)
+        if unknown:
+            raise TypeError("Got unexpected keyword argument '%s'" % unknown.pop())
+        self.kwargs = kwargs
+
+
+class FakeBotocoreConfigWithChecksumOptions(FakeBotocoreConfig):
+    OPTION_DEFAULTS = dict(FakeBotocoreConfig.OPTION_DEFAULTS, request_checksum_calculation='when_supported',
+                           response_checksum_validation='when_supported')
+
+
+def _create_s3_client_config(config_class):
+    boto3 = MagicMock()
+    botocore = MagicMock()
+    botocore.config.Config = config_class
+    with patch.object(S3ClientWrapper, '_attempt_import_boto3', return_value=boto3), \
+            patch.object(remote_file_storage_wrappers, '_botocore', botocore):
+        # bypass the cache
+        remote_file_storage_wrappers._create_s3_client.__wrapped__('profile', 'https://s3.amazonaws.com')
+    boto3.session.Session.assert_called_once_with(profile_name='profile')
+    return boto3.session.Session.return_value.client.call_args[1]['config']
+
+
+def test_create_s3_client__checksum_options():
+    config = _create_s3_client_config(FakeBotocoreConfigWithChecksumOptions)
+    assert_equals(S3ClientWrapper.MAX_POOL_CONNECTIONS, config.kwargs['max_pool_connections'])
+    assert_equals('when_required', config.kwargs['request_checksum_calculation'])
+    assert_equals('when_required', config.kwargs['response_checksum_validation'])
+
+
+def test_create_s3_client__older_botocore():
+    config = _create_s3_client_config(FakeBotocoreConfig)
+    assert_equals(S3ClientWrapper.MAX_POOL_CONNECTIONS, config.kwargs['max_pool_connections'])
+    assert_not_in('request_checksum_calculation', config.kwargs)
+    assert_not_in('response_checksum_validation', config.kwargs)
+
+
+def test_upload_file__checksum_algorithm():
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+
+    client = MagicMock()
+    try:
+        with patch.object(remote_file_storage_wrappers, '_get_s3_client', return_value=client), \
+                patch.object(S3ClientWrapper, '_auto_transfer_config'):
+            with patch.object(remote_file_storage_wrappers, '_is_crc32c_available', return_value=True):
+                S3ClientWrapper.upload_file('bucket', None, 'key', path, show_progress=False,
+                                            checksum_algorithm='CRC32C')
+                assert_equals({'ChecksumAlgorithm': 'CRC32C'},
+                              client.upload_file.call_args[1]['ExtraArgs'])
+
+            # without the CRT botocore can not calculate CRC32C, the upload is refused rather than unchecked
+            client.upload_file.reset_mock()
+            with patch.object(remote_file_storage_wrappers, '_is_crc32c_available', return_value=False):
+                assert_raises(ValueError, S3ClientWrapper.upload_file, 'bucket', None, 'key', path,
+                              show_progress=False, checksum_algorithm='CRC32C')
+                client.upload_file.assert_not_called()
+
+                # other algorithms do not need the CRT
+                S3ClientWrapper.upload_file('bucket', None, 'key', path, show_progress=False,
+                                            checksum_algorithm='SHA256')
+                assert_equals({'ChecksumAlgorithm': 'SHA256'}, client.upload_file.call_args[1]['ExtraArgs'])
+
+            # no checksum by default
+            S3ClientWrapper.upload_file('bucket', None, 'key', path, show_progress=False)
+            assert_equals({}, client.upload_file.call_args[1]['ExtraArgs'])
+    finally:
+        os.remove(path)
+
+
+def _download_file(**kwargs):
+    client = MagicMock()
+    client.head_object.return_value = {'ContentLength': 10}
+    boto3 = MagicMock()
+    transfer_module = boto3.s3.transfer
+    manager = transfer_module.create_transfer_manager.return_value.__enter__.return_value
+    with patch.object(remote_file_storage_wrappers, '_get_s3_client', return_value=client), \
+            patch.object(S3ClientWrapper, '_attempt_import_boto3', return_value=boto3), \
+            patch.object(S3ClientWrapper, '_auto_transfer_config') as mock_auto_transfer_config:
+        assert_equals('/tmp/file.txt', S3ClientWrapper.download_file('bucket', 'https://s3.amazonaws.com', 'key',
+                                                                     '/tmp/file.txt', **kwargs))
+
+    transfer_module.create_transfer_manager.assert_called_once_with(client, mock_auto_transfer_config.return_value)
+    args, kwargs = manager.download.call_args
+    assert_equals(('bucket', 'key', '/tmp/file.txt'), args)
+    manager.download.return_value.result.assert_called_once_with()
+    return client, kwargs['subscribers']
+
+
+def test_download_file__file_size_provided():
+    client, subscribers = _download_file(file_size=10, show_progress=False)
+
+    client.head_object.assert_not_called()
+    # the size is handed to the transfer manager so that it does not make a HEAD request either
+    assert_equals(1, len(subscribers))
+    future = MagicMock()
+    subscribers[0].on_queued(future)
+    future.meta.provide_transfer_size.assert_called_once_with(10)
+
+
+def test_download_file__file_size_provided_with_progress():
+    client, subscribers = _download_file(file_size=10, show_progress=True)
+
+    client.head_object.assert_not_called()
+    assert_equals(2, len(subscribers))
+
+
+def test_download_file__file_size_looked_up_for_progress():
+    client, subscribers = _download_file(show_progress=True)
+
+    client.head_object.assert_called_once_with(Bucket='bucket', Key='key')
+    # the looked up size is handed to the transfer manager as well
+    assert_equals(2, len(subscribers))
+    future = MagicMock()
+    subscribers[1].on_queued(future)
+    future.meta.provide_transfer_size.assert_called_once_with(10)
+
+
+def test_download_file__file_size_unknown():
+    client, subscribers = _download_file(show_progress=False)
+
+    client.head_object.assert_not_called()
+    assert_equals([], subscribers)
+
+
+def test_progress_callback__throttled():
+    with patch('synapseclient.remote_file_storage_wrappers.printTransferProgress') as mock_print, \
+            patch('synapseclient.remote_file_storage_wrappers.time.monotonic') as mock_time:
+        mock_time.side_effect = [100.0, 100.5, 100.5625, 100.578125, 100.75]
+        progress_callback = S3ClientWrapper._create_progress_callback_func(40, 'foo.txt', prefix='Uploading')
+
+        progress_callback(10)
+        progress_callback(10)
+        progress_callback(10)
+        progress_callback(10)
+
+        # second and third callbacks fall within the print interval, the last one completes the transfer
+        assert_equals([call(10, 40, prefix='Uploading', postfix='foo.txt', dt=0.5, previouslyTransferred=0),
+                       call(40, 40, prefix='Uploading', postfix='foo.txt', dt=0.75, previouslyTransferred=0)],
+                      mock_print.call_args_list)
+
+
+class _GatedLock(object):
+    """
+    A lock that holds up the thread named 'slow' until opened, to reproduce that thread being preempted
+    right before acquiring it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reached = threading.Event()
+        self.opened = threading.Event()
+
+    def __enter__(self):
+        if threading.current_thread().name == 'slow':
+            self.reached.set()
+            self.opened.wait(5)
+        self._lock.acquire()
+
+    def __exit__(self, *args):
+        self._lock.release()
+
+
+def test_progress_callback__older_update_not_printed_after_newer():
+    counter_lock, print_lock = threading.Lock(), _GatedLock()
+    with patch('synapseclient.remote_file_storage_wrappers.printTransferProgress') as mock_print, \
+            patch('synapseclient.remote_file_storage_wrappers.time.monotonic') as mock_time:
+        mock_time.side_effect = [100.0, 100.5, 100.5]
+        with patch.object(remote_file_storage_wrappers.threading, 'Lock', side_effect=[counter_lock, print_lock]):
+            progress_callback = S3ClientWrapper._create_progress_callback_func(20, 'foo.txt')
+
+        # the first update is counted, then held up before printing until the final update has been printed
+        slow = threading.Thread(target=progress_callback, args=(10,), name='slow')
+        slow.start()
+        assert_true(print_lock.reached.wait(5))
+        progress_callback(10)
+        print_lock.opened.set()
+        slow.join(5)
+
+    assert_equals([call(20, 20, prefix=None, postfix='foo.txt', dt=0.5, previouslyTransferred=0)],
+                  mock_print.call_args_list)
+
+
+def test_sftp_connection_pool__reuses_idle_connections():
+    connect = MagicMock(side_effect=lambda: MagicMock())
+    pool = _SFTPConnectionPool(connect, max_connections=2)
+
+    connection = pool.get()
+    pool.put(connection)
+
+    assert_is(connection, pool.get())
+    assert_equals(1, connect.call_count)
+
+
+def test_sftp_connection_pool__discards_dead_idle_connections():
+    connect = MagicMock(side_effect=lambda: MagicMock())
+    pool = _SFTPConnectionPool(connect, max_connections=1, is_alive=lambda connection: connection.alive)
+    connection = pool.get()
+    connection.alive = False
+    pool.put(connection)
+
+    new_connection = pool.get(timeout=0.01)
+
+    assert_is_not(connection, new_connection)
+    connection.close.assert_called_once_with()
+    assert_equals(2, connect.call_count)
+
+
+def test_sftp_connection_pool__expires_idle_connections():
+    connect = MagicMock(side_effect=lambda: MagicMock())
+    pool = _SFTPConnectionPool(connect, max_connections=1, max_idle_time=60)
+    with patch('synapseclient.remote_file_storage_wrappers.time.monotonic') as mock_time:
+        mock_time.return_value = 100.0
+        connection = pool.get()
+        pool.put(connection)
+
+        mock_time.return_value = 150.0
+        assert_is(connection, pool.get())
+        pool.put(connection)
+
+        # idle for longer than max_idle_time
+        mock_time.return_value = 250.0
+        new_connection = pool.get()
+
+    assert_is_not(connection, new_connection)
+    connection.close.assert_called_once_with()
+    assert_equals(2, connect.call_count)
+
+
+def test_sftp_connection_pool__capped():
+    connect = MagicMock(side_effect=lambda: MagicMock())
+    pool = _SFTPConnectionPool(connect, max_connections=2)
+
+    pool.get()
+    pool.get()
+    assert_raises(SynapseTimeoutError, pool.get, timeout=0.01)
+    assert_equals(2, connect.call_count)
+
+
+def test_sftp_connection_pool__discard_wakes_waiters():
+    pool = _SFTPConnectionPool(MagicMock, max_connections=1)
+    connection = pool.get()
+    results = []
+    waiter = threading.Thread(target=lambda: results.append(pool.get(timeout=10)))
+    waiter.start()
+
+    time.sleep(0.1)
+    start = time.time()
+    pool.discard(connection)
+    waiter.join(5)
+
+    assert_equals(1, len(results))
+    assert_is_not(connection, results[0])
+    assert_true(time.time() - start < 5)
+
+
+def test_sftp_connection_pool__put_wakes_waiters():
+    pool = _SFTPConnectionPool(MagicMock, max_connections=1)
+    connection = pool.get()
+    results = []
+    waiter = threading.Thread(target=lambda: results.append(pool.get(timeout=10)))
+    waiter.start()
+
+    time.sleep(0.1)
+    pool.put(connection)
+    waiter.join(5)
+
+    assert_equals([connection], results)
+
+
+def test_sftp_connection_pool__close():
+    pool = _SFTPConnectionPool(MagicMock, max_connections=1)
+    connection = pool.get()
+    pool.put(connection)
+
+    pool.close()
+
+    connection.close.assert_called_once_with()
+    # closing frees capacity for a new connection
+    assert_is_not(connection, pool.get())
+
+
+def test_sftp_connection_pool__discard():
+    connect = MagicMock(side_effect=lambda: MagicMock())
+    pool = _SFTPConnectionPool(connect, max_connections=1)
+    connection = pool.get()
+
+    pool.discard(connection)
+
+    connection.close.assert_called_once_with()
+    # the discarded connection is replaced by a new one
+    assert_is_not(connection, pool.get(timeout=0.01))
+    assert_equals(2, connect.call_count)
+
+
+def test_borrow_connection():
+    pool = _SFTPConnectionPool(MagicMock, max_connections=1)
+    with patch.object(SFTPWrapper, '_get_connection_pool', return_value=pool), \
+            patch.object(remote_file_storage_wrappers, '_paramiko', MagicMock(SSHException=EOFError)):
+        with SFTPWrapper._borrow_connection('host', 'user', 'password') as connection:
+            pass
+        assert_is(connection, pool.get())
+        pool.put(connection)
+
+        # errors unrelated to the connection return it to the pool
+        connection._transport.is_active.return_value = True
+        with assert_raises(IOError):
+            with SFTPWrapper._borrow_connection('host', 'user', 'password'):
+                raise IOError("No such file")
+        assert_is(connection, pool.get())
+        pool.put(connection)
+
+        # broken connections are discarded
+        with assert_raises(ConnectionResetError):
+            with SFTPWrapper._borrow_connection('host', 'user', 'password'):
+                raise ConnectionResetError()
+        connection.close.assert_called_once_with()
+        assert_is_not(connection, pool.get())
+
+
+def test_borrow_connection__interrupted():
+    pool = _SFTPConnectionPool(MagicMock, max_connections=1)
+    with patch.object(SFTPWrapper, '_get_connection_pool', return_value=pool), \
+            patch.object(remote_file_storage_wrappers, '_paramiko', MagicMock(SSHException=EOFError)):
+        with assert_raises(KeyboardInterrupt):
+            with SFTPWrapper._borrow_connection('host', 'user', 'password') as connection:
+                raise KeyboardInterrupt()
+
+    # a transfer interrupted midway may leave unread responses on the connection
+    connection.close.assert_called_once_with()
+    assert_is_not(connection, pool.get())
+
+
+def test_sftp_connection_pool__no_reuse():
+    connect = MagicMock(side_effect=lambda: MagicMock())
+    pool = _SFTPConnectionPool(connect, max_connections=2)
+    idle = [pool.get(), pool.get()]
+    for connection in idle:
+        pool.put(connection)
+
+    # at capacity the longest idle connection makes room for the new one
+    new_connection = pool.get(reuse=False)
+
+    assert_not_in(new_connection, idle)
+    assert_equals(3, connect.call_count)
+    idle[0].close.assert_called_once_with()
+    assert_false(pool.is_reused(new_connection))
+    assert_is(idle[1], pool.get(timeout=0.01))
+    assert_true(pool.is_reused(idle[1]))
+    assert_raises(SynapseTimeoutError, pool.get, timeout=0.01)
+
+
+def _call_with_connection(connections, operation):
+    connect = MagicMock(side_effect=connections)
+    pool = _SFTPConnectionPool(connect, max_connections=1)
+    with patch.object(SFTPWrapper, '_get_connection_pool', return_value=pool), \
+            patch.object(remote_file_storage_wrappers, '_paramiko', MagicMock(SSHException=EOFError)):
+        # an earlier transfer leaves the connection idle in the pool
+        SFTPWrapper._call_with_connection('host', 'user', 'password', lambda connection: None)
+        return SFTPWrapper._call_with_connection('host', 'user', 'password', operation)
+
+
+def test_call_with_connection__broken_reused_connection_replaced():
+    stale, fresh = MagicMock(), MagicMock()
+
+    def operation(connection):
+        if connection is stale:
+            # e.g. the connection was silently dropped by a firewall while idle
+            raise socket.timeout()
+        return 'done'
+
+    assert_equals('done', _call_with_connection([stale, fresh], operation))
+    stale.close.assert_called_once_with()
+
+
+def test_call_with_connection__other_errors_not_retried():
+    connection = MagicMock()
+    operation = MagicMock(side_effect=IOError("No such file"))
+    connection._transport.is_active.return_value = True
+
+    assert_raises(IOError, _call_with_connection, [connection], operation)
+    operation.assert_called_once_with(connection)
+
+
+def test_call_with_connection__new_connection_not_retried():
+    connection = MagicMock()
+    operation = MagicMock(side_effect=ConnectionResetError())
+    pool = _SFTPConnectionPool(MagicMock(return_value=connection), max_connections=1)
+    with patch.object(SFTPWrapper, '_get_connection_pool', return_value=pool), \
+            patch.object(remote_file_storage_wrappers, '_paramiko', MagicMock(SSHException=EOFError)):
+        assert_raises(ConnectionResetError, SFTPWrapper._call_with_connection, 'host', 'user', 'password', operation)
+
+    operation.assert_called_once_with(connection)
+    connection.close.assert_called_once_with()
+
+
+def test_sftp_connect():
+    pysftp = MagicMock()
+    transport = pysftp.Connection.return_value._transport
+    # window size of the transport at the time the channel is opened by setting the timeout
+    window_sizes = []
+    type(pysftp.Connection.return_value).timeout = PropertyMock(
+        side_effect=lambda value: window_sizes.append((transport.default_window_size, value)))
+
+    connection = SFTPWrapper._connect(pysftp, 'host', 'user', 'password')
+
+    pysftp.Connection.assert_called_once_with('host', username='user', password='password')
+    assert_is(pysftp.Connection.return_value, connection)
+    assert_equals(SFTPWrapper.WINDOW_SIZE, connection._transport.default_window_size)
+    assert_equals(SFTPWrapper.MAX_PACKET_SIZE, connection._transport.default_max_packet_size)
+    transport.set_keepalive.assert_called_once_with(SFTPWrapper.KEEPALIVE_INTERVAL)
+    assert_equals([(SFTPWrapper.WINDOW_SIZE, SFTPWrapper.CHANNEL_TIMEOUT)], window_sizes)
+
+
+def test_get_connection_pool__keyed_by_credentials():
+    with patch.object(SFTPWrapper, '_attempt_import_sftp'), \
+            patch.dict(SFTPWrapper._connection_pool, clear=True):
+        pool = SFTPWrapper._get_connection_pool('host', 'user', 'password')
+        assert_is(pool, SFTPWrapper._get_connection_pool('host', 'user', 'password'))
+        assert_is_not(pool, SFTPWrapper._get_connection_pool('host', 'user', 'other password'))
+        assert_is_not(pool, SFTPWrapper._get_connection_pool('host', 'other user', 'password'))
+
+
+def test_sftp_upload_files():
+    with patch.object(SFTPWrapper, 'upload_file', side_effect=lambda filepath, url, **kwargs: url + filepath) \
+            as mock_upload:
+        results = SFTPWrapper.upload_files([('/a', 'sftp://host/dir'), ('/b', 'sftp://host/dir')],
+                                           username='user', password='password')
+
+    assert_equals(['sftp://host/dir/a', 'sftp://host/dir/b'], results)
+    mock_upload.assert_any_call('/a', 'sftp://host/dir', username='user', password='password', show_progress=False)
+
+
+def test_run_in_parallel__single_threaded():
+    synapseclient.config.single_threaded = True
+    try:
+        with patch.object(remote_file_storage_wrappers.pool_provider.multiprocessing.dummy, 'Pool') as mock_pool:
+            results = remote_file_storage_wrappers._run_in_parallel(lambda x: 10 // x, [1, 0, 5], 4)
+        mock_pool.assert_not_called()
+    finally:
+        synapseclient.config.single_threaded = False
+
+    assert_equals(10, results[0])
+    assert_is_instance(results[1], ZeroDivisionError)
+    assert_equals(2, results[2])
+
+
+def test_sftp_put():
+    fd, path = tempfile.mkstemp()
+    with os.fdopen(fd, 'wb') as f:
+        f.write(b'0123456789')
+    os.utime(path, (1000, 2000))
+
+    sftp_client = MagicMock()
+    try:
+        with patch.object(remote_file_storage_wrappers, 'printTransferProgress') as mock_print:
+            SFTPWrapper._put(sftp_client, path, '/remote/dir/file.txt')
+    finally:
+        os.remove(path)
+
+    args, kwargs = sftp_client.putfo.call_args
+    assert_equals('/remote/dir/file.txt', args[1])
+    assert_equals({'file_size': 10, 'callback': mock_print, 'confirm': False}, kwargs)
+    sftp_client.utime.assert_called_once_with('/remote/dir/file.txt', (1000, 2000))
+
+
+def test_sftp_put__no_progress():
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+
+    sftp_client = MagicMock()
+    try:
+        SFTPWrapper._put(sftp_client, path, '/remote/file.txt', show_progress=False)
+    finally:
+        os.remove(path)
+
+    assert_is(None, sftp_client.putfo.call_args[1]['callback'])
+
+
+def test_sftp_get():
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+
+    sftp_client = MagicMock()
+    sftp_client.stat.return_value = MagicMock(st_size=5, st_atime=1000, st_mtime=2000)
+    remote_file = sftp_client.open.return_value.__enter__.return_value
+    remote_file.read.side_effect = [b'abc', b'de', b'']
+    try:
+        with patch.object(remote_file_storage_wrappers, 'printTransferProgress') as mock_print:
+            SFTPWrapper._get(sftp_client, '/remote/file.txt', path)
+
+        # stat before reading the file back since reading updates the access time
+        local_stat = os.stat(path)
+        with open(path, 'rb') as f:
+            assert_equals(b'abcde', f.read())
+    finally:
+        os.remove(path)
+
+    sftp_client.stat.assert_called_once_with('/remote/file.txt')
+    sftp_client.open.assert_called_once_with('/remote/file.txt', 'rb')
+    remote_file.prefetch.assert_called_once_with(5)
+    # reading stops at the first empty read
+    assert_equals(3, remote_file.read.call_count)
+    assert_equals([call(3, 5), call(5, 5)], mock_print.call_args_list)
+    assert_equals((1000, 2000), (local_stat.st_atime, local_stat.st_mtime))
+
+
+def test_download_files__results_in_submission_order():
+    error = ValueError("The key:b does not exist")
+
+    def download_file(bucket, endpoint_url, remote_file_key, download_file_path, profile_name=None,
+                      show_progress=True, file_size=None, max_concurrency=None):
+        if remote_file_key == 'b':
+            raise error
+        return download_file_path
+
+    with patch.object(S3ClientWrapper, 'download_file', side_effect=download_file) as mock_download:
+        results = S3ClientWrapper.download_files('bucket', 'https://s3.amazonaws.com',
+                                                 [('a', '/tmp/a'), ('b', '/tmp/b'), ('c', '/tmp/c', 10)],
+                                                 profile_name='profile')
+
+    assert_equals(['/tmp/a', error, '/tmp/c'], results)
+    mock_download.assert_any_call('bucket', 'https://s3.amazonaws.com', 'a', '/tmp/a', profile_name='profile',
+                                  show_progress=False, file_size=None, max_concurrency=4)
+    mock_download.assert_any_call('bucket', 'https://s3.amazonaws.com', 'c', '/tmp/c', profile_name='profile',
+                                  show_progress=False, file_size=10, max_concurrency=4)
+
+
+def test_upload_files__results_in_submission_order():
+    error = ValueError("The path: [/tmp/b] does not exist or is not a file")
+
+    def upload_file(bucket, endpoint_url, remote_file_key, upload_file_path, profile_name=None,
+                    show_progress=True, max_concurrency=None):
+        if remote_file_key == 'b':
+            raise error
+        return upload_file_path
+
+    with patch.object(S3ClientWrapper, 'upload_file', side_effect=upload_file) as mock_upload:
+        results = S3ClientWrapper.upload_files('bucket', 'https://s3.amazonaws.com',
+                                               [('a', '/tmp/a'), ('b', '/tmp/b'), ('c', '/tmp/c')],
+                                               profile_name='profile', max_workers=2)
+
+    assert_equals(['/tmp/a', error, '/tmp/c'], results)
+    mock_upload.assert_any_call('bucket', 'https://s3.amazonaws.com', 'a', '/tmp/a', profile_name='profile',
+                                show_progress=False, max_concurrency=S3ClientWrapper.MAX_POOL_CONNECTIONS // 2)
+    mock_upload.assert_any_call('bucket', 'https://s3.amazonaws.com', 'c', '/tmp/c', profile_name='profile',
+                                show_progress=False, max_concurrency=S3ClientWrapper.MAX_POOL_CONNECTIONS // 2)
+
+
+def test_get_s3_client__shared_between_threads():
+    create_s3_client = MagicMock(side_effect=lambda profile_name, endpoint_url: MagicMock())
+    with patch.object(remote_file_storage_wrappers, '_create_s3_client',
+                      functools.lru_cache(maxsize=None)(create_s3_client)):
+        clients = Pool(8).map(lambda i: remote_file_storage_wrappers._get_s3_client('profile', None), range(32))
+
+    # only the thread safe client is shared, the session it was created from is used by a single thread
+    assert_equals(1, len(set(map(id, clients))))
+    create_s3_client.assert_called_once_with('profile', None)
+
+
+def test_batch_max_concurrency():
+    # all threads of all parallel transfers fit in the shared connection pool
+    for max_workers in range(1, S3ClientWrapper.MAX_BATCH_WORKERS + 1):
+        assert_true(max_workers * S3ClientWrapper._batch_max_concurrency(max_workers)
+                    <= S3ClientWrapper.MAX_POOL_CONNECTIONS)
+    assert_true(S3ClientWrapper.MAX_AUTO_CONCURRENCY <= S3ClientWrapper.MAX_POOL_CONNECTIONS)
+
+
+def test_auto_transfer_config():
+    with patch.object(S3ClientWrapper, '_create_transfer_config') as mock_create_transfer_config:
+        S3ClientWrapper._auto_transfer_config(10 * MB)
+        mock_create_transfer_config.assert_called_with(8 * MB, S3ClientWrapper.DEFAULT_MULTIPART_THRESHOLD, 4,
+                                                       S3ClientWrapper.DEFAULT_IO_CHUNKSIZE)
+
+        S3ClientWrapper._auto_transfer_config(1 * GB)
+        mock_create_transfer_config.assert_called_with(32 * MB, S3ClientWrapper.DEFAULT_MULTIPART_THRESHOLD, 32,
+                                                       S3ClientWrapper.DEFAULT_IO_CHUNKSIZE)
+
+        S3ClientWrapper._auto_transfer_config(100 * GB)
+        mock_create_transfer_config.assert_called_with(64 * MB, S3ClientWrapper.DEFAULT_MULTIPART_THRESHOLD, 32,
+                                                       S3ClientWrapper.DEFAULT_IO_CHUNKSIZE)
+
+
+def test_auto_transfer_config__explicit_values_and_unknown_size():
+    with patch.object(S3ClientWrapper, '_create_transfer_config') as mock_create_transfer_config:
+        S3ClientWrapper._auto_transfer_config(1 * GB, multipart_chunksize=16 * MB, max_concurrency=2)
+        mock_create_transfer_config.assert_called_with(16 * MB, S3ClientWrapper.DEFAULT_MULTIPART_THRESHOLD, 2,
+                                                       S3ClientWrapper.DEFAULT_IO_CHUNKSIZE)
+
+        S3ClientWrapper._auto_transfer_config(None)
+        mock_create_transfer_config.assert_called_with(S3ClientWrapper.DEFAULT_MULTIPART_CHUNKSIZE,
+                                                       S3ClientWrapper.DEFAULT_MULTIPART_THRESHOLD,
+                                                       S3ClientWrapper.DEFAULT_MAX_CONCURRENCY,
+                                                       S3ClientWrapper.DEFAULT_IO_CHUNKSIZE)
+
+
+class FakeChunksizeAdjuster(object):
+    MIN_SIZE = 5
+
+    def adjust_chunksize(self, current_chunksize, file_size=None):
+        return max(current_chunksize, self.MIN_SIZE)
+
+
+@contextlib.contextmanager
+def _patch_multiprocess_upload(worker_client):
+    s3transfer_utils = MagicMock(ChunksizeAdjuster=FakeChunksizeAdjuster)
+    context = MagicMock()
+    context.Pool.side_effect = lambda processes, **kwargs: Pool(processes)
+    with patch.object(remote_file_storage_wrappers.multiprocessing, 'get_context', return_value=context) \
+            as mock_get_context, \
+            patch.object(remote_file_storage_wrappers, '_upload_worker_client', worker_client), \
+            patch.object(remote_file_storage_wrappers, '_s3transfer', MagicMock(utils=s3transfer_utils)):
+        yield mock_get_context
+
+
+def test_multiprocess_upload():
+    fd, path = tempfile.mkstemp()
+    with os.fdopen(fd, 'wb') as f:
+        f.write(b'0123456789abcdefghijKLMNO')
+
+    client = MagicMock()
+    client.create_multipart_upload.return_value = {'UploadId': 'upload-id'}
+    worker_client = MagicMock()
+    worker_client.upload_part.side_effect = lambda **kwargs: {'ETag': 'etag%s' % kwargs['PartNumber'],
+                                                              'ChecksumCRC32C': 'crc%s' % kwargs['PartNumber']}
+    transfer_config = MagicMock(multipart_chunksize=10, max_concurrency=4)
+    progress_callback = MagicMock()
+
+    try:
+        with _patch_multiprocess_upload(worker_client) as mock_get_context:
+            S3ClientWrapper._multiprocess_upload(client, 'bucket', 'https://s3.amazonaws.com', 'key', path, 25,
+                                                 'profile', transfer_config, 'CRC32C', progress_callback)
+    finally:
+        os.remove(path)
+
+    mock_get_context.assert_called_once_with('spawn')
+
+    client.create_multipart_upload.assert_called_once_with(Bucket='bucket', Key='key', ChecksumAlgorithm='CRC32C')
+    worker_client.upload_part.assert_any_call(Bucket='bucket', Key='key', UploadId='upload-id', PartNumber=3,
+                                              Body=b'KLMNO', ChecksumAlgorithm='CRC32C')
+    client.complete_multipart_upload.assert_called_once_with(
+        Bucket='bucket', Key='key', UploadId='upload-id',
+        MultipartUpload={'Parts': [{'PartNumber': 1, 'ETag': 'etag1', 'ChecksumCRC32C': 'crc1'},
+                                   {'PartNumber': 2, 'ETag': 'etag2', 'ChecksumCRC32C': 'crc2'},
+                                   {'PartNumber': 3, 'ETag': 'etag3', 'ChecksumCRC32C': 'crc3'}]})
+    assert_equals(25, sum(args[0] for args, kwargs in progress_callback.call_args_list))
+    client.abort_multipart_upload.assert_not_called()
+
+
+def test_multiprocess_upload__aborted_on_failure():
+    fd, path = tempfile.mkstemp()
+    with os.fdopen(fd, 'wb') as f:
+        f.write(b'0123456789')
+
+    client = MagicMock()
+    client.create_multipart_upload.return_value = {'UploadId': 'upload-id'}
+    worker_client = MagicMock()
+    worker_client.upload_part.side_effect = IOError("connection reset")
+    transfer_config = MagicMock(multipart_chunksize=5, max_concurrency=4)
+
+    try:
+        with _patch_multiprocess_upload(worker_client):
+            assert_raises(IOError, S3ClientWrapper._multiprocess_upload, client, 'bucket', 'https://s3.amazonaws.com',
+                          'key', path, 10, 'profile', transfer_config, None, None)
+    finally:
+        os.remove(path)
+
+    client.complete_multipart_upload.assert_not_called()
+    client.abort_multipart_upload.assert_called_once_with(Bucket='bucket', Key='key', UploadId='upload-id')
+
+
+def test_multiprocess_upload__part_size_adjusted():
+    fd, path = tempfile.mkstemp()
+    with os.fdopen(fd, 'wb') as f:
+        f.write(b'0123456789')
+
+    client = MagicMock()
+    client.create_multipart_upload.return_value = {'UploadId': 'upload-id'}
+    worker_client = MagicMock()
+    worker_client.upload_part.side_effect = lambda **kwargs: {'ETag': 'etag%s' % kwargs['PartNumber']}
+    # below the minimum part size
+    transfer_config = MagicMock(multipart_chunksize=2, max_concurrency=4)
+
+    try:
+        with _patch_multiprocess_upload(worker_client):
+            S3ClientWrapper._multiprocess_upload(client, 'bucket', 'https://s3.amazonaws.com', 'key', path, 10,
+                                                 'profile', transfer_config, None, None)
+    finally:
+        os.remove(path)
+
+    assert_equals([b'01234', b'56789'],
+                  sorted(kwargs['Body'] for args, kwargs in worker_client.upload_part.call_args_list))
+
+
+def test_attempt_import_sftp__imported_once():
+    pysftp = MagicMock()
+    paramiko = MagicMock()
+    with patch.object(remote_file_storage_wrappers, '_pysftp', None), \
+            patch.object(remote_file_storage_wrappers, '_paramiko', None), \
+            patch.object(remote_file_storage_wrappers, 'attempt_import', return_value=pysftp) as mock_attempt_import, \
+            patch.dict('sys.modules', {'paramiko': paramiko}):
+        assert_is(pysftp, SFTPWrapper._attempt_import_sftp())
+        assert_is(pysftp, SFTPWrapper._attempt_import_sftp())
+        assert_equals(1, mock_attempt_import.call_count)
+        # paramiko is kept along with pysftp
+        assert_is(paramiko, remote_file_storage_wrappers._paramiko)
+
+
+def test_attempt_import_boto3__imported_once():
+    boto3 = MagicMock()
+    botocore = MagicMock()
+    s3transfer = MagicMock()
+    modules = {'boto3': boto3, 'boto3.s3': boto3.s3, 'boto3.s3.transfer': boto3.s3.transfer,
+               'botocore': botocore, 'botocore.config': botocore.config, 'botocore.exceptions': botocore.exceptions,
+               's3transfer': s3transfer, 's3transfer.utils': s3transfer.utils}
+    with patch.object(remote_file_storage_wrappers, '_boto3', None), \
+            patch.object(remote_file_storage_wrappers, '_botocore', None), \
+            patch.object(remote_file_storage_wrappers, '_s3transfer', None), \
+            patch.object(remote_file_storage_wrappers, 'attempt_import', return_value=boto3) as mock_attempt_import, \
+            patch.dict('sys.modules', modules):
+        assert_is(boto3, S3ClientWrapper._attempt_import_boto3())
+        assert_is(boto3, S3ClientWrapper._attempt_import_boto3())
+        assert_equals(1, mock_attempt_import.call_count)
+        # the dependencies of boto3 used for transfers are kept along with it
+        assert_is(botocore, remote_file_storage_wrappers._botocore)
+        assert_is(s3transfer, remote_file_storage_wrappers._s3transfer)